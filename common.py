@@ -10,39 +10,49 @@ __docformat__ = "markdown en"
 # so don't import anything from calibre_plugins
 
 import os
-import re
+import stat
 import sys
 import time
 import traceback
+import zipfile
+from functools import lru_cache
 from functools import partial
+from threading import Lock
 
-from calibre import prints
 from calibre.constants import config_dir
 from calibre.constants import preferred_encoding
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.book.base import NULL_VALUES
 from calibre.ebooks.oeb.polish.container import EpubContainer
 from calibre.ebooks.oeb.polish.container import OPF_NAMESPACES
-from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils.logging import ANSIStream
 from polyglot.builtins import is_py3
-from polyglot.io import PolyglotStringIO
 
 # lxml isn't great, but I don't have access to defusedxml
+from lxml.etree import XPath  # skipcq: BAN-B410
 from lxml.etree import _Element  # skipcq: BAN-B410
 
 if is_py3:
     from typing import Dict
     from typing import List
     from typing import Optional
+    from typing import Tuple
     from typing import Union
 
-KOBO_JS_RE = re.compile(r".*/?kobo.*?\.js$", re.IGNORECASE)
 XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
 CONFIGDIR = os.path.join(config_dir, "plugins")
 REFERENCE_KEPUB = os.path.join(CONFIGDIR, "reference.kepub.epub")
 PLUGIN_VERSION = (3, 7, 2)
 PLUGIN_MINIMUM_CALIBRE_VERSION = (5, 0, 0)
+COVER_IMAGE_PROPERTY = "cover-image"
+
+# Clark notation tag names for OPF elements, built once for Element.iter()
+OPF_ITEM_TAG = f"{{{OPF_NAMESPACES['opf']}}}item"
+OPF_META_TAG = f"{{{OPF_NAMESPACES['opf']}}}meta"
+
+MANIFEST_ITEM_BY_ID_XPATH = XPath(
+    "./opf:manifest/opf:item[@id=$cover_id]", namespaces=OPF_NAMESPACES
+)
 
 
 class Logger:
@@ -56,10 +66,14 @@ class Logger:
             or "calibre-debug" in sys.argv[0]
         ):
             self.log_level = "DEBUG"
+        self._level_num = self.LEVELS[self.log_level]
 
         # According to Kovid, calibre always uses UTF-8 for the Python 3 version
         self.preferred_encoding = "UTF-8" if is_py3 else preferred_encoding
         self.outputs = [ANSIStream()]
+        # Messages come from KEPubContainer worker threads, never from other
+        # processes, so a thread lock is all that's needed to serialize output.
+        self._lock = Lock()
 
         self.debug = partial(self.print_formatted_log, "DEBUG")
         self.info = partial(self.print_formatted_log, "INFO")
@@ -71,28 +85,34 @@ class Logger:
 
     @staticmethod
     def _tag_args(level: str, *args: str) -> List[str]:
-        now = time.localtime()
-        buf = PolyglotStringIO()
-        tagged_args: List[str] = []
-        for arg in args:
-            prints(time.strftime("%Y-%m-%d %H:%M:%S", now), file=buf, end=" ")
-            buf.write("[")
-            prints(level, file=buf, end="")
-            buf.write("] ")
-            prints(arg, file=buf, end="")
+        # The timestamp and level are the same for every argument, so only
+        # format them once.
+        prefix = f"{time.strftime('%Y-%m-%d %H:%M:%S')} [{level}] "
+        return [
+            prefix
+            + (arg.decode("UTF-8", "replace") if isinstance(arg, bytes) else str(arg))
+            for arg in args
+        ]
 
-            tagged_args.append(buf.getvalue())
-            buf.truncate(0)
+    def _prints(self, level: str, *args, **kwargs) -> None:
+        with self._lock:
+            for o in self.outputs:
+                o.prints(self.LEVELS[level], *args, **kwargs)
+                if hasattr(o, "flush"):
+                    o.flush()
 
-        return tagged_args
+    def is_enabled_for(self, level: str) -> bool:
+        """Check if messages at the given level will be logged.
 
-    def _prints(self, level: str, *args, **kwargs) -> None:
-        for o in self.outputs:
-            o.prints(self.LEVELS[level], *args, **kwargs)
-            if hasattr(o, "flush"):
-                o.flush()
+        Use this to avoid building expensive log messages that would be dropped.
+        """
+        return self.LEVELS[level] >= self._level_num
 
     def print_formatted_log(self, level: str, *args, **kwargs) -> None:
+        # Don't pay for formatting messages nobody will see
+        if not self.is_enabled_for(level):
+            return
+
         tagged_args = self._tag_args(level, *args)
         self._prints(level, *tagged_args, **kwargs)
 
@@ -106,30 +126,131 @@ class Logger:
 log = Logger()
 
 
+@lru_cache(maxsize=None)
+def _resource(name: str) -> bytes:
+    # Plugin resources never change while calibre is running, so only read each
+    # one from the plugin ZIP file once.
+    return get_resources(name)
+
+
+@lru_cache(maxsize=32)
+def _hyphenation_css(
+    min_chars: int,
+    min_chars_before: int,
+    min_chars_after: int,
+    limit_lines: Union[int, str],
+) -> bytes:
+    # The hyphenation options rarely change between books in a batch, so keep the
+    # formatted and encoded stylesheet for each combination that's been used.
+    return (
+        _resource("css/hyphenation.css.tmpl")
+        .decode()
+        .format(
+            hyphen_min_chars=min_chars,
+            hyphen_min_chars_before=min_chars_before,
+            hyphen_min_chars_after=min_chars_after,
+            hyphen_limit_lines=limit_lines,
+        )
+        .encode()
+    )
+
+
+def _is_kobo_js(name: str) -> bool:
+    # Cheaper than a regular expression for checking every name in a container.
+    # Most names aren't JavaScript at all, so reject those before lowercasing the
+    # whole basename.
+    if name[-3:].lower() != ".js":
+        return False
+
+    # Like the old ".*kobo.*\.js" pattern, "kobo" can appear anywhere in the
+    # file name, not just at the start.
+    return "kobo" in name.rsplit("/", 1)[-1].lower()
+
+
+@lru_cache(maxsize=1)
+def _load_reference_kobo_js(path: str, mtime: float) -> Optional[bytes]:
+    # The mtime is part of the cache key, so a replaced reference KePub is read
+    # again once _reference_kepub_mtime() sees the new mtime, which can take up to
+    # REFERENCE_KEPUB_STAT_TTL seconds. Only the JavaScript file is needed, so read
+    # it straight out of the ZIP file instead of extracting the whole book.
+    with zipfile.ZipFile(path) as reference_kepub:
+        name = next((n for n in reference_kepub.namelist() if _is_kobo_js(n)), None)
+        if name is None:
+            return None
+
+        return reference_kepub.read(name)
+
+
+# How long, in seconds, the result of checking the reference KePub on disk is
+# trusted before checking again.
+REFERENCE_KEPUB_STAT_TTL = 5.0
+_reference_kepub_checked_at: Optional[float] = None
+_reference_kepub_last_mtime: Optional[float] = None
+
+
+def _reference_kepub_mtime() -> Optional[float]:
+    """Get the modification time of the reference KePub, or None if it's missing.
+
+    During a batch conversion this is called once per book, so the result is
+    reused for a few seconds instead of calling stat() on the same file each time.
+    """
+    global _reference_kepub_checked_at, _reference_kepub_last_mtime
+    now = time.monotonic()
+    checked_at = _reference_kepub_checked_at
+    if checked_at is not None and now - checked_at < REFERENCE_KEPUB_STAT_TTL:
+        return _reference_kepub_last_mtime
+
+    try:
+        st = os.stat(REFERENCE_KEPUB)
+        mtime = st.st_mtime if stat.S_ISREG(st.st_mode) else None
+    except OSError:
+        mtime = None
+
+    _reference_kepub_checked_at = now
+    _reference_kepub_last_mtime = mtime
+    return mtime
+
+
+def _get_reference_kobo_js() -> Optional[bytes]:
+    """Get the Kobo JavaScript file from the reference KePub, if there is one.
+
+    The reference KePub is only opened again if it has changed since it was last
+    read. Returns the contents of the JavaScript file.
+    """
+    mtime = _reference_kepub_mtime()
+    if mtime is None:
+        return None
+
+    return _load_reference_kobo_js(REFERENCE_KEPUB, mtime)
+
+
+def _mark_cover_image(node: _Element, container: EpubContainer) -> None:
+    if node.get("properties", "") != COVER_IMAGE_PROPERTY:
+        log.info("Setting cover-image property")
+        node.set("properties", COVER_IMAGE_PROPERTY)
+        container.dirty(container.opf_name)
+    else:
+        log.warning("Item node is already set as cover-image")
+
+
 # The logic here to detect a cover image is mostly duplicated from
 # metadata/writer.py. Updates to the logic here probably need an accompanying
 # update over there.
-def modify_epub(
-    container: EpubContainer,
-    filename: str,
-    metadata: Optional[Metadata] = None,
-    opts: Optional[Dict[str, Union[str, bool]]] = None,
-) -> None:
-    """Modify the ePub file to make it KePub-compliant."""
-    _modify_start = time.time()
-    opts = opts or {}
-
-    # Search for the ePub cover
-    # TODO: Refactor out cover detection logic so it can be directly used in
-    # metadata/writer.py
-    found_cover = False
-    opf: _Element = container.opf
-    cover_meta_node_list: List[_Element] = opf.xpath(
-        './opf:metadata/opf:meta[@name="cover"]', namespaces=OPF_NAMESPACES
-    )
-
-    if len(cover_meta_node_list) > 0:
-        cover_meta_node: _Element = cover_meta_node_list[0]
+def _find_cover_item(opf: _Element) -> Optional[_Element]:
+    """Find the manifest item for the cover image in an OPF tree.
+
+    The item named by the cover meta node is used if there is one, otherwise the
+    first image item with an ID starting with "cover" (in any case).
+    """
+    # Only the first cover meta node matters, so a plain iteration that stops as
+    # soon as it's found is cheaper than evaluating an XPath expression.
+    cover_meta_node: Optional[_Element] = None
+    for meta in opf.iter(OPF_META_TAG):
+        if meta.get("name") == "cover":
+            cover_meta_node = meta
+            break
+
+    if cover_meta_node is not None:
         cover_id = cover_meta_node.attrib.get("content", None)
 
         log.debug("Found meta node with name=cover")
@@ -137,134 +258,112 @@ def modify_epub(
         if cover_id:
             log.info(f"Found cover image ID '{cover_id}'")
 
-            cover_node_list: _Element = opf.xpath(
-                f'./opf:manifest/opf:item[@id="{cover_id}"]',
-                namespaces=OPF_NAMESPACES,
+            cover_node_list: List[_Element] = MANIFEST_ITEM_BY_ID_XPATH(
+                opf, cover_id=cover_id
             )
             if len(cover_node_list) > 0:
-                cover_node: _Element = cover_node_list[0]
-
                 log.debug("Found an item node with cover ID")
-
-                if cover_node.attrib.get("properties", "") != "cover-image":
-                    log.info("Setting cover-image property")
-                    cover_node.set("properties", "cover-image")
-                    container.dirty(container.opf_name)
-                else:
-                    log.warning("Item node is already set as cover-image")
-                found_cover = True
+                return cover_node_list[0]
 
     # It's possible that the cover image can't be detected this way. Try
     # looking for the cover image ID in the OPF manifest.
-    if not found_cover:
-        log.debug("Looking for cover image in OPF manifest")
-
-        node_list: List[_Element] = opf.xpath(
-            "./opf:manifest/opf:item[(translate(@id, "
-            + "'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
-            + '="cover" or starts-with(translate(@id, '
-            + "'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
-            + ', "cover")) and starts-with(@media-type, "image")]',
-            namespaces=OPF_NAMESPACES,
-        )
-        if len(node_list) > 0:
-            log.info(
-                f"Found {len(node_list)} nodes, assuming the first is the right node"
-            )
+    log.debug("Looking for cover image in OPF manifest")
+    for item in opf.iter(OPF_ITEM_TAG):
+        media_type = item.get("media-type", "")
+        item_id = item.get("id", "")
+        if media_type.startswith("image") and item_id.lower().startswith("cover"):
+            log.info(f"Found cover image item with ID '{item_id}'")
+            return item
+
+    return None
 
-            node: _Element = node_list[0]
-            if node.attrib.get("properties", "") != "cover-image":
-                log.info("Setting cover-image property")
-                node.set("properties", "cover-image")
-                container.dirty(container.opf_name)
-            else:
-                log.warning("Item node is already set as cover-image")
-            found_cover = True
+
+def modify_epub(
+    container: EpubContainer,
+    filename: str,
+    metadata: Optional[Metadata] = None,
+    opts: Optional[Dict[str, Union[str, bool]]] = None,
+) -> None:
+    """Modify the ePub file to make it KePub-compliant."""
+    _modify_start = time.time()
+    opts = opts or {}
+
+    # Metadata attribute access goes through Metadata.__getattribute__, so only
+    # look up the fields that are needed once.
+    if metadata is not None:
+        md_language = metadata.language
+        md_title = metadata.title
+        md_authors = metadata.authors
+    else:
+        md_language = md_title = md_authors = None
+
+    # Search for the ePub cover
+    # TODO: Refactor out cover detection logic so it can be directly used in
+    # metadata/writer.py
+    cover_node = _find_cover_item(container.opf)
+    if cover_node is not None:
+        _mark_cover_image(cover_node, container)
 
     # Hyphenate files?
+    hyphen_min_chars = int(opts.get("hyphen_min_chars", 6))
     if opts.get("no-hyphens", False):
-        nohyphen_css = PersistentTemporaryFile(suffix="_nohyphen", prefix="kepub_")
-        nohyphen_css.write(get_resources("css/no-hyphens.css"))
-        nohyphen_css.close()
-
-        css_path = os.path.basename(
-            container.copy_file_to_container(
-                nohyphen_css.name, name="kte-css/no-hyphens.css"
-            )
+        css_name = container.write_file_to_container(
+            _resource("css/no-hyphens.css"), name="kte-css/no-hyphens.css"
         )
-        container.add_content_file_reference(f"kte-css/{css_path}")
-        os.unlink(nohyphen_css.name)
-    elif opts.get("hyphenate", False) and int(opts.get("hyphen_min_chars", 6)) > 0:
-        if metadata and metadata.language == NULL_VALUES["language"]:
+        container.add_content_file_reference(css_name)
+    elif opts.get("hyphenate", False) and hyphen_min_chars > 0:
+        if md_language == NULL_VALUES["language"]:
             log.warning(
                 "Hyphenation is enabled but not overriding content file "
                 + "language. Hyphenation may use the wrong dictionary."
             )
-        hyphen_css = PersistentTemporaryFile(suffix="_hyphenate", prefix="kepub_")
-        css_template = get_resources("css/hyphenation.css.tmpl").decode()
         hyphen_limit_lines = opts.get("hyphen_limit_lines", 2)
         if hyphen_limit_lines == 0:
             hyphen_limit_lines = "no-limit"
-        hyphen_css.write(
-            css_template.format(
-                hyphen_min_chars=opts.get("hyphen_min_chars"),
-                hyphen_min_chars_before=opts.get("hyphen_min_chars_before", 3),
-                hyphen_min_chars_after=opts.get("hyphen_min_chars_after", 3),
-                hyphen_limit_lines=hyphen_limit_lines,
-            ).encode()
-        )
-        hyphen_css.close()
-
-        css_path = os.path.basename(
-            container.copy_file_to_container(
-                hyphen_css.name, name="kte-css/hyphenation.css"
-            )
+        css_name = container.write_file_to_container(
+            _hyphenation_css(
+                hyphen_min_chars,
+                int(opts.get("hyphen_min_chars_before", 3)),
+                int(opts.get("hyphen_min_chars_after", 3)),
+                hyphen_limit_lines,
+            ),
+            name="kte-css/hyphenation.css",
         )
-        container.add_content_file_reference(f"kte-css/{css_path}")
-        os.unlink(hyphen_css.name)
+        container.add_content_file_reference(css_name)
 
     # Now smarten punctuation
     if opts.get("smarten_punctuation", False):
         container.smarten_punctuation()
 
     if opts.get("extended_kepub_features", True):
-        if metadata is not None:
+        if md_authors is not None and log.is_enabled_for("INFO"):
             log.info(
-                f"Adding extended Kobo features to {metadata.title} by "
-                + " and ".join(metadata.authors)
+                f"Adding extended Kobo features to {md_title} by "
+                + " and ".join(md_authors)
             )
 
         # Add the Kobo span and div tags
         container.convert()
 
         # Check to see if there's already a kobo*.js in the ePub
-        skip_js = False
-        for name in container.name_path_map:
-            if KOBO_JS_RE.match(name):
-                skip_js = True
-                break
-
-        if os.path.isfile(REFERENCE_KEPUB) and not skip_js:
-            reference_container = EpubContainer(REFERENCE_KEPUB, log)
-            for name in reference_container.name_path_map:
-                if KOBO_JS_RE.match(name):
-                    jsname = container.copy_file_to_container(
-                        os.path.join(reference_container.root, name), name="kobo.js"
-                    )
-                    container.add_content_file_reference(jsname)
-                    break
+        skip_js = any(_is_kobo_js(name) for name in container.name_path_map)
 
-        # Add the Kobo style hacks
-        stylehacks_css = PersistentTemporaryFile(suffix="_stylehacks", prefix="kepub_")
-        stylehacks_css.write(get_resources("css/style-hacks.css"))
-        stylehacks_css.close()
-
-        css_path = os.path.basename(
-            container.copy_file_to_container(
-                stylehacks_css.name, name="kte-css/stylehacks.css"
+        reference_kobo_js = None if skip_js else _get_reference_kobo_js()
+        reference_names = []
+        if reference_kobo_js is not None:
+            jsname = container.write_file_to_container(
+                reference_kobo_js, name="kobo.js"
             )
+            reference_names.append(jsname)
+
+        # Add the Kobo style hacks
+        css_name = container.write_file_to_container(
+            _resource("css/style-hacks.css"), name="kte-css/stylehacks.css"
         )
-        container.add_content_file_reference(f"kte-css/{css_path}")
+        reference_names.append(css_name)
+
+        # Reference both in one pass, so each content file is only written once
+        container.add_content_file_reference(*reference_names)
     os.unlink(filename)
     container.commit(filename)
 
@@ -272,8 +371,15 @@ def modify_epub(
     log.info(f"modify_epub took {_modify_time:0.2f} seconds")
 
 
-def intValueChanged(widget, singular, plural, *args, **kwargs):
+@lru_cache(maxsize=1)
+def _spinbox_types() -> Tuple[type, ...]:
+    # common.py is also loaded by conversion jobs without a GUI, so PyQt5 can't be
+    # imported at module scope. Import it on first use instead.
     from PyQt5 import QtWidgets
 
-    if isinstance(widget, (QtWidgets.QSpinBox, QtWidgets.QDoubleSpinBox)):
+    return (QtWidgets.QSpinBox, QtWidgets.QDoubleSpinBox)
+
+
+def intValueChanged(widget, singular, plural, *args, **kwargs):
+    if isinstance(widget, _spinbox_types()):
         widget.setSuffix(" " + ngettext(singular, plural, widget.value()))
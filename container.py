@@ -13,6 +13,7 @@ __docformat__ = "restructuredtext en"
 # so don't import anything from calibre_plugins.
 
 import os
+import posixpath
 import re
 import shutil
 import string
@@ -21,7 +22,8 @@ import traceback
 from collections import defaultdict
 from concurrent.futures import Future
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+from concurrent.futures import wait
+from functools import lru_cache
 from typing import Callable
 from typing import Iterator
 from typing import List
@@ -54,6 +56,14 @@ ENCRYPTION_NAMESPACES = {
     "deenc": "http://ns.adobe.com/digitaleditions/enc",
 }
 XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+XHTML_SPAN_TAG = f"{{{XHTML_NAMESPACE}}}span"
+XHTML_HEAD_TAG = f"{{{XHTML_NAMESPACE}}}head"
+XHTML_BODY_TAG = f"{{{XHTML_NAMESPACE}}}body"
+XHTML_DIV_TAG = f"{{{XHTML_NAMESPACE}}}div"
+XHTML_LINK_TAG = f"{{{XHTML_NAMESPACE}}}link"
+XHTML_SCRIPT_TAG = f"{{{XHTML_NAMESPACE}}}script"
+HEADING_TAGS = tuple(f"{{*}}h{level}" for level in range(1, 7))
+XHTML_NAMESPACES = {"xhtml": XHTML_NAMESPACE}
 SKIPPED_TAGS = frozenset(
     [
         "button",
@@ -85,10 +95,55 @@ EMPTY_HEADINGS_RE = re.compile(r"(?i)<(h\d+)[^>]*?>\s*</\1>", re.UNICODE | re.MU
 ELLIPSIS_RE = re.compile(r"(?u)(?<=\w)\s?(\.\s+?){2}\.", re.UNICODE | re.MULTILINE)
 MS_CRUFT_RE_1 = re.compile(r"<o:p>\s*</o:p>", re.UNICODE | re.MULTILINE)
 MS_CRUFT_RE_2 = re.compile(r"(?i)</?st1:\w+>", re.UNICODE | re.MULTILINE)
+# Matches anything in the original markup that could become Microsoft cruft for
+# MS_CRUFT_RE_1 or MS_CRUFT_RE_2 to remove once it has been parsed and serialized.
+MS_CRUFT_HINT_RE = re.compile(r"(?i)<o:p|</?st1:")
 TEXT_SPLIT_RE = re.compile(
     r'(.*?(?:[\.\!\?\:][\'"\u201c\u201d\u2018\u2019\u2026]*(?=\s)|(?=\s*$)))',
     re.UNICODE | re.MULTILINE,
 )
+# Text between two tags containing anything smartyPants() would change: quotes,
+# backticks, dashes, ellipses, or a backslash escape.
+SMARTYPANTS_TRIGGER_RE = re.compile(r"""(?:^|>)[^<]*?(?:["'`\\]|--|\.\s?\.\s?\.)""")
+KOBO_DIV_COUNT_XPATH = etree.XPath(
+    'count(//xhtml:div[@id="book-inner"])', namespaces=XHTML_NAMESPACES
+)
+DIV_COUNT_XPATH = etree.XPath("count(//xhtml:div)", namespaces=XHTML_NAMESPACES)
+P_COUNT_XPATH = etree.XPath("count(//xhtml:p)", namespaces=XHTML_NAMESPACES)
+KOBO_SPAN_COUNT_XPATH = etree.XPath(
+    'count(.//xhtml:span[@class="koboSpan" or starts-with(@id, "kobo.")])',
+    namespaces=XHTML_NAMESPACES,
+)
+ENCRYPTION_METHOD_XPATH = etree.XPath(
+    "./enc:EncryptedData/enc:EncryptionMethod[@Algorithm]",
+    namespaces=ENCRYPTION_NAMESPACES,
+)
+
+
+# Shared by every container, created on first use by _get_executor()
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Content files are processed in Python while holding the GIL for most of
+    # the work, so there's no point running more threads than there are CPUs.
+    # Reusing one pool also saves starting new threads for every pass over the
+    # content of every book.
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 4, thread_name_prefix="KEPubContainer"
+            )
+        return _executor
+
+
+@lru_cache(maxsize=1024)
+def _relative_href(name: str, base_dir: str) -> str:
+    # The same stylesheet or script is referenced from every content file, which
+    # are usually all in the same few directories, so most lookups are repeats.
+    return os.path.relpath(name, base_dir).replace(os.sep, "/")
 
 
 # TODO: Refactor InvalidEpub from here and device/driver.py to be a common class
@@ -116,23 +171,73 @@ class KEPubContainer(EpubContainer):
         super(KEPubContainer, self).__init__(epub_path, log, *args, **kwargs)
         self.my_thread = threading.current_thread()
         self.log = log
+        # Per-node debug messages are only formatted when they will be logged.
+        # Loggers without a level check always get them.
+        is_enabled_for = getattr(log, "is_enabled_for", None)
+        self._debug_enabled = is_enabled_for is None or is_enabled_for("DEBUG")
         self.log.debug(f"Creating KePub Container for ePub at {epub_path}")
 
-        self.__run_async_over_content(self.forced_cleanup)
         if do_cleanup:
-            self.__run_async_over_content(self.clean_markup)
+            self.__run_async_over_content(self.__cleanup_impl)
+        else:
+            self.__run_async_over_content(self.forced_cleanup)
+
+    def __cleanup_impl(self, name: str) -> str:
+        # Run both cleanups on a file in one task, so it doesn't have to wait for
+        # every other file to finish the first one before starting the second.
+        self.log.debug(f"Forcing cleanup and cleaning markup for file {name}")
+        html = self.raw_data(name, decode=True, normalize_to_nfc=True)
+        if html is None:
+            self.log.warning(f"No HTML content in {name}")
+            return name
+
+        root = self.parse_xhtml(self.__forced_cleanup_text(html))
+        if MS_CRUFT_HINT_RE.search(html):
+            # clean_markup() works on the markup as serialized after the forced
+            # cleanup. Serializing in memory gives the same text without writing
+            # the file out and reading it back in between the two passes.
+            self.replace(name, root)
+            html = self.decode(self.serialize_item(name), normalize_to_nfc=True)
+            root = self.parse_xhtml(self.__clean_markup_text(html))
+        else:
+            # Without any Microsoft cruft, only the empty headings are left to
+            # remove, and that can be done on the tree without parsing again.
+            self.__remove_empty_headings(root)
+        self.replace(name, root)
+        self.commit_item(name, keep_parsed=True)
+        return name
+
+    @staticmethod
+    def __remove_empty_headings(root: etree._Element) -> None:
+        # The tree version of EMPTY_HEADINGS_RE: headings with nothing but
+        # whitespace in them are dropped, and the text after them is kept.
+        empty_headings = [
+            heading
+            for heading in root.iter(*HEADING_TAGS)
+            if len(heading) == 0 and (not heading.text or heading.text.isspace())
+        ]
+        for heading in empty_headings:
+            parent = heading.getparent()
+            if heading.tail:
+                previous = heading.getprevious()
+                if previous is None:
+                    parent.text = (parent.text or "") + heading.tail
+                else:
+                    previous.tail = (previous.tail or "") + heading.tail
+            parent.remove(heading)
 
     def html_names(self) -> Iterator[str]:
         """Get all HTML files in the OPF file.
 
         A generator function that yields only HTML file names from the ePub.
         """
+        # Manifest hrefs are always relative to the OPF with "/" separators, so
+        # posixpath gives the container name directly on every platform.
+        opf_dir = posixpath.dirname(self.opf_name)
         for node in self.opf_xpath("//opf:manifest/opf:item[@href and @media-type]"):
             if node.get("media-type") in HTML_MIMETYPES:
-                href = os.path.join(os.path.dirname(self.opf_name), node.get("href"))
-                href = os.path.normpath(href).replace(os.sep, "/")
-                href = unquote(href)
-                yield href
+                href = posixpath.normpath(posixpath.join(opf_dir, node.get("href")))
+                yield unquote(href)
 
     @property
     def is_drm_encumbered(self) -> bool:
@@ -151,10 +256,7 @@ class KEPubContainer(EpubContainer):
                     # means an encumbered file. This may be wrong, but so far
                     # it's proven accurate.
                     return True
-                for elem in xml.xpath(
-                    "./enc:EncryptedData/enc:EncryptionMethod[@Algorithm]",
-                    namespaces=ENCRYPTION_NAMESPACES,
-                ):
+                for elem in ENCRYPTION_METHOD_XPATH(xml):
                     alg = elem.get("Algorithm")
 
                     # Anything not an acceptable encryption algorithm is a
@@ -184,78 +286,103 @@ class KEPubContainer(EpubContainer):
         if not os.path.isfile(path):
             raise ValueError(_("A source path must be given"))
         if name is None:
-            basename: str = os.path.basename(path)
-        else:
-            basename: str = name
-        item = self.generate_item(basename, media_type=mt)
-        # Unnecessary casse but pyright things href_to_name could return many things
-        basename = str(self.href_to_name(item.get("href"), self.opf_name))
+            name = os.path.basename(path)
+        basename = self.__add_manifest_item(name, mt)
 
         self.log.info(f"Copying file '{path}' to '{self.root}' as '{basename}'")
 
+        shutil.copy(path, os.path.join(self.root, basename))
+
+        return basename
+
+    def write_file_to_container(
+        self, data: bytes, name: str, mt: Optional[str] = None
+    ) -> str:
+        """Write data into this Container instance as a new file.
+
+        Unlike copy_file_to_container(), this does not need the data to be
+        written to a temporary file first.
+
+        @param data: The contents of the new file.
+        @param name: The name to give to the new file, relative to the
+        Container root.
+        @param mt: The MIME type of the file to set in the manifest. Set to
+        None to auto-detect.
+
+        @return: The name of the file relative to the Container root
+        """
+        basename = self.__add_manifest_item(name, mt)
+
+        self.log.info(f"Writing file '{basename}' to '{self.root}'")
+
+        with open(os.path.join(self.root, basename), "wb") as f:
+            f.write(data)
+
+        return basename
+
+    def __add_manifest_item(self, name: str, mt: Optional[str]) -> str:
+        item = self.generate_item(name, media_type=mt)
+        # Unnecessary casse but pyright things href_to_name could return many things
+        basename = str(self.href_to_name(item.get("href"), self.opf_name))
+
         try:
             # Throws an error we can ignore if the directory already exists
             os.makedirs(os.path.dirname(os.path.join(self.root, basename)))
         except Exception:
             pass
 
-        shutil.copy(path, os.path.join(self.root, basename))
-
         return basename
 
-    def add_content_file_reference(self, name: str) -> None:
-        """Add a reference to the named file to all content files.
+    def add_content_file_reference(self, *names: str) -> None:
+        """Add a reference to the named files to all content files.
 
-        Adds a reference to the named file (see self.name_path_map) to all
+        Adds a reference to each named file (see self.name_path_map) to all
         content files (self.html_names()). Currently only CSS files with a
         MIME type of text/css and JavaScript files with a MIME type of
-        application/x-javascript are supported.
+        application/x-javascript are supported. Each content file is only
+        written once, however many names are given.
         """
-        if name not in self.name_path_map or name not in self.mime_map:
-            raise ValueError(_(f"A valid file name must be given (got {name})"))
+        for name in names:
+            if name not in self.name_path_map or name not in self.mime_map:
+                raise ValueError(_(f"A valid file name must be given (got {name})"))
 
-        self.__run_async_over_content(self.__add_content_file_reference_impl, (name,))
+        self.__run_async_over_content(self.__add_content_file_reference_impl, names)
 
-    def __add_content_file_reference_impl(self, infile: str, name: str) -> None:
-        self.log.debug(f"Adding reference to {name} to file {infile}")
+    def __add_content_file_reference_impl(self, infile: str, *names: str) -> None:
         root = self.parsed(infile)
         if root is None:
             raise Exception(_(f"Could not retrieve content file {infile}"))
-        head = root.xpath("./xhtml:head", namespaces={"xhtml": XHTML_NAMESPACE})
+        head = next(root.iterchildren(XHTML_HEAD_TAG), None)
         if head is None:
-            head = root.makeelement(f"{{{XHTML_NAMESPACE}}}head")
+            head = root.makeelement(XHTML_HEAD_TAG)
             root.insert(0, head)
-        else:
-            head = head[0]
-        if head is None:
-            raise Exception(
-                _(
-                    "A <head> section was found but was undefined in content "
-                    + f"file {infile}"
+
+        changed = False
+        for name in names:
+            self.log.debug(f"Adding reference to {name} to file {infile}")
+            mime_type = self.mime_map[name]
+            if mime_type == CSS_MIMETYPE:
+                elem = head.makeelement(
+                    XHTML_LINK_TAG,
+                    rel="stylesheet",
+                    href=_relative_href(name, os.path.dirname(infile)),
                 )
-            )
+            elif mime_type == JS_MIMETYPE:
+                elem = head.makeelement(
+                    XHTML_SCRIPT_TAG,
+                    type="text/javascript",
+                    src=_relative_href(name, os.path.dirname(infile)),
+                )
+            else:
+                elem = None
 
-        if self.mime_map[name] == CSS_MIMETYPE:
-            elem = head.makeelement(
-                f"{{{XHTML_NAMESPACE}}}link",
-                rel="stylesheet",
-                href=os.path.relpath(name, os.path.dirname(infile)).replace(
-                    os.sep, "/"
-                ),
-            )
-        elif self.mime_map[name] == JS_MIMETYPE:
-            elem = head.makeelement(
-                f"{{{XHTML_NAMESPACE}}}script",
-                type="text/javascript",
-                src=os.path.relpath(name, os.path.dirname(infile)).replace(os.sep, "/"),
-            )
-        else:
-            elem = None
+            if elem is not None:
+                head.append(elem)
+                if mime_type == CSS_MIMETYPE:
+                    self.fix_tail(elem)
+                changed = True
 
-        if elem is not None:
-            head.append(elem)
-            if self.mime_map[name] == CSS_MIMETYPE:
-                self.fix_tail(elem)
+        if changed:
             self.commit_item(infile, keep_parsed=True)
 
     @staticmethod
@@ -289,12 +416,28 @@ class KEPubContainer(EpubContainer):
             self.log.warning(f"No HTML content in {name}")
             return
 
-        encoding_match = ENCODING_RE.search(str(html[:75]))
+        self.replace(name, self.parse_xhtml(self.__forced_cleanup_text(html)))
+        self.commit_item(name, keep_parsed=True)
+
+    @staticmethod
+    def __forced_cleanup_text(html: str) -> str:
+        # Only the XML declaration at the start is of interest. endpos limits the
+        # search the same way slicing would, without copying the start of the file.
+        encoding_match = ENCODING_RE.search(html, 0, 75)
         if encoding_match and encoding_match.group(1).upper() != "UTF-8":
-            html = re.sub(encoding_match.group(1), "UTF-8", html, 1, re.MULTILINE)
+            # The match is against the start of the same string, so its position
+            # can be used directly instead of compiling the encoding name as a
+            # pattern, where characters like "." would be treated as wildcards.
+            html = (
+                html[: encoding_match.start(1)]
+                + "UTF-8"
+                + html[encoding_match.end(1) :]
+            )
 
-        # Force meta and link tags to be self-closing
-        html = SELF_CLOSING_RE.sub(r"<\1 \2 />", html)
+        # Force meta and link tags to be self-closing. Only tags with a closing
+        # tag can match, and most files have none, so skip scanning those.
+        if "</meta>" in html or "</link>" in html:
+            html = SELF_CLOSING_RE.sub(r"<\1 \2 />", html)
 
         # Force open script tags
         html = FORCE_OPEN_TAG_RE.sub(r"<\1 \2></\1>", html)
@@ -302,8 +445,7 @@ class KEPubContainer(EpubContainer):
         # Remove Unicode replacement characters
         html = html.replace("\ufffd", "")
 
-        self.replace(name, self.parse_xhtml(html))
-        self.commit_item(name, keep_parsed=True)
+        return html
 
     def clean_markup(self, name: str) -> None:
         """Clean HTML markup.
@@ -316,15 +458,17 @@ class KEPubContainer(EpubContainer):
         if html is None:
             self.log.warning(f"No HTML content in {name}")
 
+        self.replace(name, self.parse_xhtml(self.__clean_markup_text(html)))
+        self.commit_item(name, keep_parsed=True)
+
+    @staticmethod
+    def __clean_markup_text(html: str) -> str:
         # Get rid of Microsoft cruft
         html = MS_CRUFT_RE_1.sub(" ", html)
         html = MS_CRUFT_RE_2.sub("", html)
 
         # Remove empty headings
-        html = EMPTY_HEADINGS_RE.sub("", html)
-
-        self.replace(name, self.parse_xhtml(html))
-        self.commit_item(name, keep_parsed=True)
+        return EMPTY_HEADINGS_RE.sub("", html)
 
     def smarten_punctuation(self) -> None:
         self.__run_async_over_content(self.__smarten_punctuation_impl)
@@ -337,6 +481,7 @@ class KEPubContainer(EpubContainer):
         html = self.raw_data(name, decode=True, normalize_to_nfc=True)
         if html is None:
             self.log.warning(f"No HTML content in file {name}")
+        original_html = html
 
         # Fix non-breaking space indents
         html = preprocessor.fix_nbsp_indents(html)
@@ -346,7 +491,15 @@ class KEPubContainer(EpubContainer):
         # B : backtick quotes (``double'' and `single')
         # d : dashes
         # e : ellipses
-        html = smartyPants(html, attr="qBde")
+        # Only text outside of tags is changed, and only where it has something to
+        # smarten, so smartyPants is skipped for files without any.
+        if SMARTYPANTS_TRIGGER_RE.search(html):
+            html = smartyPants(html, attr="qBde")
+
+        # A file with nothing to fix doesn't need to be parsed and written again
+        if html == original_html:
+            return
+
         self.replace(name, self.parse_xhtml(html))
 
         self.commit_item(name, keep_parsed=True)
@@ -358,21 +511,24 @@ class KEPubContainer(EpubContainer):
             traceback.print_stack()
             raise Exception("__run_async called by a subthread")
 
+        pool = _get_executor()
         futures: List[Future] = []
-        with ThreadPoolExecutor() as pool:
-            try:
-                for arg in args:
-                    self.log.debug(
-                        f"Starting thread: func={func.__name__}, name={arg[0]}"
-                    )
-                    futures.append(pool.submit(func, *arg))
-
-                for future in futures:
-                    name = future.result(timeout=60)
-                    self.log.debug(f"thread processing {name} finished")
-            except Exception as e:
-                self.log.error(f"Unhandled exception in thread processing. {str(e)}")
-                raise e
+        try:
+            for arg in args:
+                self.log.debug(f"Starting thread: func={func.__name__}, name={arg[0]}")
+                futures.append(pool.submit(func, *arg))
+
+            for future in futures:
+                name = future.result(timeout=60)
+                self.log.debug(f"thread processing {name} finished")
+        except Exception as e:
+            # Don't leave other files being changed in the background once this
+            # returns. Anything not started yet is dropped.
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            self.log.error(f"Unhandled exception in thread processing. {str(e)}")
+            raise e
 
         # Be sure dirtied trees are committed. These should be trees dirtied in
         # our superclass because trees dirtied here have already been committed
@@ -389,19 +545,25 @@ class KEPubContainer(EpubContainer):
 
     def convert(self) -> None:
         """The entry point for converting to KePub"""
-        self.__run_async_over_content(self.add_kobo_spans)
-        self.__run_async_over_content(self.add_kobo_divs)
+        self.__run_async_over_content(self.__convert_impl)
+
+    def __convert_impl(self, name: str) -> str:
+        # Both passes work on the same parsed tree, so only serialize it once
+        # after both are done instead of after each one.
+        self.add_kobo_spans(name, commit=False)
+        self.add_kobo_divs(name, commit=False)
+        if name in self.dirtied:
+            self.commit_item(name, keep_parsed=True)
+        return name
 
-    def add_kobo_divs(self, name) -> None:
-        """Add KePub divs to the HTML file."""
+    def add_kobo_divs(self, name: str, commit: bool = True) -> str:
+        """Add KePub divs to the HTML file.
+
+        If commit is False, a changed file is left dirty for the caller to commit.
+        """
         self.log.debug(f"Adding Kobo divs to {name}")
         root = self.parsed(name)
-        kobo_div_count = int(
-            root.xpath(
-                'count(//xhtml:div[@id="book-inner"])',
-                namespaces={"xhtml": XHTML_NAMESPACE},
-            )
-        )
+        kobo_div_count = int(KOBO_DIV_COUNT_XPATH(root))
         if kobo_div_count > 0:
             self.log.warning(
                 _(f"Skipping file {name}")
@@ -419,12 +581,8 @@ class KEPubContainer(EpubContainer):
         # spectacular way, so, err, don't ;).
         # FIXME: Try to figure out what's really happening instead of
         # sidestepping the issue?
-        div_count = int(
-            root.xpath("count(//xhtml:div)", namespaces={"xhtml": XHTML_NAMESPACE})
-        )
-        p_count = int(
-            root.xpath("count(//xhtml:p)", namespaces={"xhtml": XHTML_NAMESPACE})
-        )
+        div_count = int(DIV_COUNT_XPATH(root))
+        p_count = int(P_COUNT_XPATH(root))
         if div_count > p_count:
             self.log.warning(
                 _(f"Skipping file {name}")
@@ -441,66 +599,38 @@ class KEPubContainer(EpubContainer):
         self.__add_kobo_divs_to_body(root)
 
         self.replace(name, root)
-        self.commit_item(name, keep_parsed=True)
+        if commit:
+            self.commit_item(name, keep_parsed=True)
         return name
 
     @staticmethod
     def __add_kobo_divs_to_body(root: etree._Element) -> None:
-        body = root.xpath("./xhtml:body", namespaces={"xhtml": XHTML_NAMESPACE})[0]
-
-        # save node content for later
-        body_text = body.text
-        body_children = deepcopy(body.getchildren())
-        body_attrs = {}
-        for key in list(body.keys()):
-            body_attrs[key] = body.get(key)
-
-        # reset current node, to start from scratch
-        body.clear()
-
-        # restore node attributes
-        for key, value in body_attrs.items():
-            body.set(key, value)
-
-        # Wrap the full body in a div
-        inner_div = etree.Element(
-            f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-inner"}
-        )
-
-        # Handle the node text
-        if body_text is not None:
-            inner_div.text = body_text
-
-        # re-add the node children, but as children of the div
-        for child in body_children:
-            # save child tail for later
-            child_tail = child.tail
-            child.tail = None
+        body = next(root.iterchildren(XHTML_BODY_TAG))
+
+        # Wrap the full body in a div. append() moves each child along with its
+        # tail, and the body keeps its attributes, so nothing needs to be saved
+        # and restored around it.
+        inner_div = etree.Element(XHTML_DIV_TAG, attrib={"id": "book-inner"})
+        inner_div.text = body.text
+        body.text = None
+        for child in list(body):
             inner_div.append(child)
-            # Handle the child tail
-            if child_tail is not None:
-                inner_div[-1].tail = child_tail
 
         # Finally, wrap that div in another one...
-        outer_div = etree.Element(
-            f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-columns"}
-        )
+        outer_div = etree.Element(XHTML_DIV_TAG, attrib={"id": "book-columns"})
         outer_div.append(inner_div)
 
         # And re-chuck the full div pyramid in the now empty body
         body.append(outer_div)
 
-    def add_kobo_spans(self, name: str) -> None:
-        """Add KePub spans (used for in-book location) the HTML file."""
+    def add_kobo_spans(self, name: str, commit: bool = True) -> None:
+        """Add KePub spans (used for in-book location) the HTML file.
+
+        If commit is False, a changed file is left dirty for the caller to commit.
+        """
         self.log.debug(f"Adding Kobo spans to {name}")
         root = self.parsed(name)
-        kobo_span_count = int(
-            root.xpath(
-                'count(.//xhtml:span[@class="koboSpan" '
-                + 'or starts-with(@id, "kobo.")])',
-                namespaces={"xhtml": XHTML_NAMESPACE},
-            )
-        )
+        kobo_span_count = int(KOBO_SPAN_COUNT_XPATH(root))
         if kobo_span_count > 0:
             self.log.warning(
                 _(f"Skipping file {name}")
@@ -513,79 +643,108 @@ class KEPubContainer(EpubContainer):
             )
             return
 
-        body = root.xpath("./xhtml:body", namespaces={"xhtml": XHTML_NAMESPACE})[0]
+        body = next(root.iterchildren(XHTML_BODY_TAG))
         self._add_kobo_spans_to_node(body, name)
 
         self.replace(name, root)
-        self.commit_item(name, keep_parsed=True)
+        if commit:
+            self.commit_item(name, keep_parsed=True)
 
     def _add_kobo_spans_to_node(
         self, node: etree._Element, name: str
     ) -> etree._Element:
-        # process node only if it is not a comment or a processing instruction
-        if node is None or isinstance(
-            node, (etree._Comment, etree._ProcessingInstruction)
-        ):
-            if node is not None:
-                node.tail = None
-            self.log.debug(f"[{name}] Skipping comment/ProcessingInstruction node")
+        node, node_children = self.__reset_node_for_kobo_spans(node, name)
+        if node_children is None:
             return node
 
-        # Special case some tags
-        special_tag_match = re.search(r"^(?:\{[^\}]+\})?(\w+)$", node.tag)
-        if special_tag_match:
-            # Skipped tags are just flat out skipped
-            if special_tag_match.group(1) in SKIPPED_TAGS:
-                self.log.debug(f"[{name}] Skipping '{special_tag_match.group(1)}' tag")
-                return node
+        # Walk the tree with an explicit stack rather than recursing, so deeply
+        # nested markup can't hit the recursion limit. Each entry holds a node,
+        # its remaining children, and the tail text to convert into spans on its
+        # parent once the node and all of its children are done.
+        stack = [(node, iter(node_children), None)]
+        while stack:
+            parent, children, _ = stack[-1]
+            child = next(children, None)
+            if child is None:
+                _, _, parent_tail = stack.pop()
+                # the child tail is converted to spans
+                if parent_tail is not None:
+                    if self._append_kobo_spans_from_text(
+                        stack[-1][0], parent_tail, name
+                    ):
+                        self.paragraph_counter[name] += 1
+                continue
 
-            # Special tags get wrapped in a span and their children are ignored
-            if special_tag_match.group(1) in SPECIAL_TAGS:
+            # save child tail for later
+            child_tail = child.tail
+            child.tail = None
+            child, grandchildren = self.__reset_node_for_kobo_spans(child, name)
+            parent.append(child)
+            stack.append((child, iter(grandchildren or ()), child_tail))
+
+        return node
+
+    def __reset_node_for_kobo_spans(
+        self, node: etree._Element, name: str
+    ) -> Tuple[etree._Element, Optional[List[etree._Element]]]:
+        # Convert the text of a single node to spans and detach its children.
+        # Returns the node to put in the tree in its place, and the children to
+        # re-add to it, or None if its children are to be left alone.
+
+        # process node only if it is an element. Comments, processing instructions
+        # and entities all have a factory function as their tag instead of a name.
+        if node is None or callable(node.tag):
+            if node is not None:
+                node.tail = None
+            if self._debug_enabled:
+                self.log.debug(f"[{name}] Skipping comment/ProcessingInstruction node")
+            return node, None
+
+        # Special case some tags. Only the tag name without the namespace matters,
+        # and splitting that off the tag is much cheaper than a regex.
+        tag_name = node.tag.rpartition("}")[2]
+
+        # Skipped tags are just flat out skipped
+        if tag_name in SKIPPED_TAGS:
+            if self._debug_enabled:
+                self.log.debug(f"[{name}] Skipping '{tag_name}' tag")
+            return node, None
+
+        # Special tags get wrapped in a span and their children are ignored
+        if tag_name in SPECIAL_TAGS:
+            if self._debug_enabled:
                 self.log.debug(
-                    f"[{name}] Wrapping '{special_tag_match.group(1)}' tag and "
-                    + "ignoring children"
+                    f"[{name}] Wrapping '{tag_name}' tag and ignoring children"
                 )
-                span = etree.Element(
-                    f"{{{XHTML_NAMESPACE}}}span",
-                    attrib={
-                        "id": f"kobo.{self.paragraph_counter[name]}.1",
-                        "class": "koboSpan",
-                    },
-                )
-                span.append(node)
-                return span
+            span = etree.Element(
+                XHTML_SPAN_TAG,
+                attrib={
+                    "id": f"kobo.{self.paragraph_counter[name]}.1",
+                    "class": "koboSpan",
+                },
+            )
+            span.append(node)
+            return span, None
 
         # save node content for later
         node_text = node.text
-        node_children = deepcopy(node.getchildren())
-        node_attrs = {}
-        for key in list(node.keys()):
-            node_attrs[key] = node.get(key)
+        # The children are moved back under this node by the caller, so there's
+        # no need to copy them first.
+        node_children = list(node)
+        node_attrs = dict(node.attrib)
 
         # reset current node, to start from scratch
         node.clear()
 
         # restore node attributes
-        for key, value in node_attrs.items():
-            node.set(key, value)
+        node.attrib.update(node_attrs)
 
         # the node text is converted to spans
         if node_text is not None:
             if self._append_kobo_spans_from_text(node, node_text, name):
                 self.paragraph_counter[name] += 1
 
-        # re-add the node children
-        for child in node_children:
-            # save child tail for later
-            child_tail = child.tail
-            child.tail = None
-            node.append(self._add_kobo_spans_to_node(child, name))
-            # the child tail is converted to spans
-            if child_tail is not None:
-                if self._append_kobo_spans_from_text(node, child_tail, name):
-                    self.paragraph_counter[name] += 1
-
-        return node
+        return node, node_children
 
     def _append_kobo_spans_from_text(
         self, node: etree._Element, text: str, name: str
@@ -603,21 +762,23 @@ class KEPubContainer(EpubContainer):
         else:
             node[-1].tail = groups[0]
 
-        # append each sentence in its own span
+        # append each sentence in its own span. The rest of the groups alternate
+        # between a sentence and the whitespace after it, so pair them up from a
+        # single iterator instead of slicing the list twice.
         segment_counter = 1
-        for g, ws in zip(groups[1::2], groups[2::2]):
-            if g.strip() == "":
+        id_prefix = f"kobo.{self.paragraph_counter[name]}."
+        rest = iter(groups)
+        next(rest)
+        for g, ws in zip(rest, rest):
+            if not g or g.isspace():
                 continue
-            span = etree.Element(
-                f"{{{XHTML_NAMESPACE}}}span",
-                attrib={
-                    "class": "koboSpan",
-                    "id": f"kobo.{self.paragraph_counter[name]}.{segment_counter}",
-                },
+            span = etree.SubElement(
+                node,
+                XHTML_SPAN_TAG,
+                attrib={"class": "koboSpan", "id": id_prefix + str(segment_counter)},
             )
             span.text = g
             span.tail = ws
-            node.append(span)
             segment_counter += 1
 
         return len(groups) > 1  # Return true if any spans were added.
@@ -169,6 +169,7 @@ class KEPUBInput(EPUBInput):
         """Perform any needed post-input processing on the book."""
         log("KEPUBInput::postprocess_book - start")
         from calibre.ebooks.oeb.base import XHTML_NS
+        from lxml.etree import XPath  # skipcq: BAN-B410
 
         # The Kobo spans wrap each sentence. Remove them and add their text to
         # the parent tag.
@@ -194,14 +195,14 @@ class KEPUBInput(EPUBInput):
             log("KEPUBInput::postprocess_book - not stripping kobo spans")
             return
 
+        # Compile the lookup once rather than for every file in the spine.
+        kobo_spans = XPath('//h:span[@class="koboSpan"]', namespaces={"h": XHTML_NS})
         for item in oeb.spine:
             log("item.__class__.__name__", item.__class__.__name__)
             if not hasattr(item.data, "xpath"):
                 continue
 
-            for a in item.data.xpath(
-                '//h:span[@class="koboSpan"]', namespaces={"h": XHTML_NS}
-            ):
+            for a in kobo_spans(item.data):
                 refactor_span(a)
 
         log("KEPUBInput::postprocess_book - end")
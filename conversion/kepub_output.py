@@ -19,6 +19,10 @@ from calibre.customize.conversion import OutputFormatPlugin
 from calibre.ebooks.conversion.plugins.epub_output import EPUBOutput
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.book.base import NULL_VALUES
+from calibre.ebooks.oeb.polish.container import OPF_NAMESPACES
+
+# lxml isn't great, but I don't have access to defusedxml
+from lxml.etree import XPath  # skipcq: BAN-B410
 
 from calibre_plugins.kepubout import common
 from calibre_plugins.kepubout.container import KEPubContainer
@@ -31,6 +35,15 @@ except NameError:
     pass
 
 
+DC_TITLE_XPATH = XPath("./opf:metadata/dc:title/text()", namespaces=OPF_NAMESPACES)
+DC_AUTHORS_XPATH = XPath(
+    './opf:metadata/dc:creator[@opf:role="aut"]/text()', namespaces=OPF_NAMESPACES
+)
+DC_LANGUAGE_XPATH = XPath(
+    "./opf:metadata/dc:language/text()", namespaces=OPF_NAMESPACES
+)
+
+
 class KEPubOutput(OutputFormatPlugin):
     """Allows calibre to convert any known source format to a KePub file."""
 
@@ -161,25 +174,21 @@ class KEPubOutput(OutputFormatPlugin):
             "kepub_output_version": ".".join([str(n) for n in self.version]),
             "kepub_output_currenttime": datetime.utcnow().ctime(),
         }
-        kte_data_file = self.temporary_file("_KePubOutputPluginInfo")
-        kte_data_file.write(json.dumps(o).encode("UTF-8"))
-        kte_data_file.close()
-        container.copy_file_to_container(
-            kte_data_file.name, name="plugininfo.kte", mt="application/json"
+        container.write_file_to_container(
+            json.dumps(o).encode("UTF-8"), name="plugininfo.kte", mt="application/json"
         )
 
-        title = container.opf_xpath("./opf:metadata/dc:title/text()")
+        opf = container.opf
+        title = DC_TITLE_XPATH(opf)
         if len(title) > 0:
             title = title[0]
         else:
             title = NULL_VALUES["title"]
-        authors = container.opf_xpath(
-            './opf:metadata/dc:creator[@opf:role="aut"]/text()'
-        )
+        authors = DC_AUTHORS_XPATH(opf)
         if len(authors) < 1:
             authors = NULL_VALUES["authors"]
         mi = Metadata(title, authors)
-        language = container.opf_xpath("./opf:metadata/dc:language/text()")
+        language = DC_LANGUAGE_XPATH(opf)
         if len(language) > 0:
             mi.languages = language
             language = language[0]
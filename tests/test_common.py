@@ -5,7 +5,9 @@
 import glob
 import os
 import sys
+import tempfile
 import unittest
+import zipfile
 
 from typing import Dict
 from typing import List
@@ -16,6 +18,7 @@ src_dir = os.path.dirname(test_dir)
 test_libdir = os.path.join(src_dir, "pylib", f"python{sys.version_info.major}")
 sys.path += glob.glob(os.path.join(test_libdir, "*.zip"))
 
+from lxml import etree
 from unittest import mock
 
 from calibre_plugins.kobotouch_extended import common
@@ -44,6 +47,13 @@ TEST_STRINGS: List[Dict[str, Set[str]]] = [
     },
 ]
 TEST_TIME = "2020-04-01 01:02:03"
+TEST_OPF = """<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <manifest>
+    <item href="cover.jpg" id="cover" media-type="image/jpeg"/>
+    <item href="quoted.jpg" id="it's &quot;quoted&quot;" media-type="image/jpeg"/>
+    <item href="part001.xhtml" id="part001" media-type="application/xhtml+xml"/>
+  </manifest>
+</package>"""
 
 
 def gen_lang_code():
@@ -133,6 +143,110 @@ class TestCommon(unittest.TestCase):
         logger._tag_args.assert_called_with("ERROR", "Oh noes!")
         self.assertEqual(logger._prints.call_count, 2)
 
+    def test_logger_skips_disabled_levels(self) -> None:
+        for envvar in ("CALIBRE_DEVELOP_FROM", "CALIBRE_DEBUG"):
+            if envvar in os.environ:
+                del os.environ[envvar]
+        logger = common.Logger()
+        self.assertFalse(logger.is_enabled_for("DEBUG"))
+        self.assertTrue(logger.is_enabled_for("INFO"))
+        self.assertTrue(logger.is_enabled_for("ERROR"))
+        logger._prints = mock.MagicMock()
+        logger._tag_args = mock.MagicMock(return_value=["Hello, World"])
+
+        logger.debug("Hello, World")
+        logger._tag_args.assert_not_called()
+        logger._prints.assert_not_called()
+
+        logger.info("Hello, World")
+        logger._tag_args.assert_called_with("INFO", "Hello, World")
+        logger._prints.assert_called_with("INFO", "Hello, World")
+
+    def test_manifest_item_by_id_xpath(self) -> None:
+        opf = etree.fromstring(TEST_OPF)
+        for cover_id, href in (
+            ("cover", "cover.jpg"),
+            ("part001", "part001.xhtml"),
+            ('it\'s "quoted"', "quoted.jpg"),
+        ):
+            items = common.MANIFEST_ITEM_BY_ID_XPATH(opf, cover_id=cover_id)
+            self.assertEqual(len(items), 1)
+            self.assertEqual(items[0].get("href"), href)
+
+        self.assertListEqual(
+            common.MANIFEST_ITEM_BY_ID_XPATH(opf, cover_id="missing"), []
+        )
+
+    @mock.patch("calibre_plugins.kobotouch_extended.common.log", mock.MagicMock())
+    def test_find_cover_item(self) -> None:
+        # No cover meta node, so the first image with a "cover" ID is used
+        opf = etree.fromstring(TEST_OPF)
+        self.assertEqual(common._find_cover_item(opf).get("href"), "cover.jpg")
+
+        metadata = etree.SubElement(opf, f"{{{common.OPF_NAMESPACES['opf']}}}metadata")
+        meta = etree.SubElement(metadata, common.OPF_META_TAG)
+        meta.set("name", "cover")
+        meta.set("content", 'it\'s "quoted"')
+        self.assertEqual(common._find_cover_item(opf).get("href"), "quoted.jpg")
+
+        # A cover meta node pointing nowhere falls back to the manifest search
+        meta.set("content", "missing")
+        self.assertEqual(common._find_cover_item(opf).get("href"), "cover.jpg")
+
+        for item in opf.iter(common.OPF_ITEM_TAG):
+            item.set("id", "item-" + item.get("id"))
+        self.assertIsNone(common._find_cover_item(opf))
+
+    def test_is_kobo_js(self) -> None:
+        for name in (
+            "kobo.js",
+            "js/kobo.js",
+            "OEBPS/js/KoboReader.JS",
+            "js/mykobo.js",
+        ):
+            self.assertTrue(common._is_kobo_js(name), name)
+
+        for name in ("kobo.css", "js/reader.js", "kobo/reader.js", "kobo.js.bak"):
+            self.assertFalse(common._is_kobo_js(name), name)
+
+    def test_load_reference_kobo_js(self) -> None:
+        with tempfile.TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, "reference.kepub.epub")
+            with zipfile.ZipFile(path, "w") as z:
+                z.writestr("mimetype", "application/epub+zip")
+                z.writestr("OEBPS/js/kobo.js", "var kobo = 1;")
+
+            # Bypass the cache so each call reads the file
+            load = common._load_reference_kobo_js.__wrapped__
+            self.assertEqual(load(path, 0), b"var kobo = 1;")
+
+            with zipfile.ZipFile(path, "w") as z:
+                z.writestr("mimetype", "application/epub+zip")
+            self.assertIsNone(load(path, 0))
+
+    def test_reference_kepub_mtime_is_cached(self) -> None:
+        stat_result = os.stat(__file__)
+        with (
+            mock.patch.multiple(
+                common,
+                _reference_kepub_checked_at=None,
+                _reference_kepub_last_mtime=None,
+            ),
+            mock.patch(
+                "calibre_plugins.kobotouch_extended.common.os.stat",
+                mock.MagicMock(return_value=stat_result),
+            ) as stat_mock,
+        ):
+            self.assertEqual(common._reference_kepub_mtime(), stat_result.st_mtime)
+            self.assertEqual(common._reference_kepub_mtime(), stat_result.st_mtime)
+            stat_mock.assert_called_once_with(common.REFERENCE_KEPUB)
+
+            # Once the TTL has passed the file is checked again
+            common._reference_kepub_checked_at -= common.REFERENCE_KEPUB_STAT_TTL
+            stat_mock.side_effect = FileNotFoundError
+            self.assertIsNone(common._reference_kepub_mtime())
+            self.assertEqual(stat_mock.call_count, 2)
+
 
 if __name__ == "__main__":
     unittest.main(module="test_common", verbosity=2)
@@ -89,6 +89,22 @@ class TestContainer(TestAssertions):
         self.assertIn(self.container.mime_map[container_name], container.HTML_MIMETYPES)
         self.assertIn("content.opf", self.container.dirtied)
 
+    def test_write_file_to_container(self):
+        with open(self.files["css"], "rb") as f:
+            data = f.read()
+
+        container_name = self.container.write_file_to_container(
+            data, name="kte-css/test.css"
+        )
+        self.assertEqual(container_name, "kte-css/test.css")
+        self.assertIn(container_name, self.container.name_path_map)
+        self.assertEqual(
+            self.container.mime_map[container_name], container.CSS_MIMETYPE
+        )
+        self.assertIn("content.opf", self.container.dirtied)
+        with open(os.path.join(self.tmpdir, container_name), "rb") as f:
+            self.assertEqual(f.read(), data)
+
     def __run_added_test(
         self, expect_changed, added_func
     ):  # type: (bool, Callable) -> None
@@ -161,6 +177,26 @@ class TestContainer(TestAssertions):
         )
         self.assertEqual(element_count, 5)
 
+    def test_convert_adds_spans_and_divs(self):
+        source_file = self.files["test_without_spans_with_comments"]
+        container_name = self.container.copy_file_to_container(source_file)
+
+        self.container.convert()
+
+        self.assertNotIn(container_name, self.container.dirtied)
+        with open(os.path.join(self.tmpdir, container_name), "rb") as f:
+            o = etree.fromstring(f.read())
+        for xpath in (
+            'count(//xhtml:span[@class="koboSpan"])',
+            'count(//xhtml:div[@id="book-inner"])',
+            'count(//xhtml:div[@id="book-columns"])',
+        ):
+            self.assertGreater(
+                o.xpath(xpath, namespaces={"xhtml": container.XHTML_NAMESPACE}),
+                0,
+                xpath,
+            )
+
     def test_clean_markup(self):
         container_name = self.container.copy_file_to_container(
             self.files["dirty_markup"]
@@ -202,6 +238,50 @@ class TestContainer(TestAssertions):
                 )
             )
 
+    def test_forced_cleanup_replaces_encoding(self):
+        container_name = self.container.write_file_to_container(
+            b'<?xml version="1.0" encoding="ISO.8859.1"?>\n'
+            + b'<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+            + b"<p>ISO.8859.1</p></body></html>",
+            name="latin1.html",
+        )
+
+        with mock.patch.object(
+            self.container, "parse_xhtml", wraps=self.container.parse_xhtml
+        ) as parse_xhtml:
+            self.container.forced_cleanup(container_name)
+
+        html = parse_xhtml.call_args[0][0]
+        self.assertIn('encoding="UTF-8"', html)
+        self.assertIn("<p>ISO.8859.1</p>", html)
+
+    def test_cleanup_removes_empty_headings(self):
+        container_name = self.container.write_file_to_container(
+            (
+                f'<html xmlns="{container.XHTML_NAMESPACE}"><body>'
+                + "<h1>Title</h1><h2> </h2>Before<h3/>After<div><h4></h4>Kept</div>"
+                + "</body></html>"
+            ).encode("utf-8"),
+            name="headings.html",
+        )
+        self.container.commit()
+
+        cleaned = container.KEPubContainer(
+            self.tmpdir,
+            self.log,
+            tdir=os.path.join(self.basedir, "cleaned"),
+            do_cleanup=True,
+        )
+
+        html = cleaned.parsed(container_name)
+        body = html[0]
+        self.assertListEqual(
+            [etree.QName(child).localname for child in body], ["h1", "div"]
+        )
+        self.assertEqual(body[0].tail, "BeforeAfter")
+        self.assertEqual(body[1].text, "Kept")
+        self.assertEqual(len(body[1]), 0)
+
     # This test also covers KEPubContainer.fix_tail()
     def test_add_css(self):
         html_container_name = self.container.copy_file_to_container(
@@ -232,6 +312,24 @@ class TestContainer(TestAssertions):
             )
         )
 
+    def test_add_css_without_head(self):
+        html_container_name = self.container.write_file_to_container(
+            (
+                f'<html xmlns="{container.XHTML_NAMESPACE}">'
+                + "<body><p>No head here.</p></body></html>"
+            ).encode("utf-8"),
+            name="no_head.html",
+        )
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+
+        self.container.add_content_file_reference(css_container_name)
+        html = self.container.parsed(html_container_name)
+        css_post_count = html.xpath(
+            f'count(/xhtml:html/xhtml:head/xhtml:link[@href="{css_container_name}"])',
+            namespaces={"xhtml": container.XHTML_NAMESPACE},
+        )
+        self.assertEqual(css_post_count, 1)
+
     def test_add_js(self):
         html_container_name = self.container.copy_file_to_container(
             self.files["test_with_spans"]
@@ -261,6 +359,32 @@ class TestContainer(TestAssertions):
             )
         )
 
+    def test_add_css_and_js_together(self):
+        html_container_name = self.container.copy_file_to_container(
+            self.files["test_with_spans"]
+        )
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+        js_container_name = self.container.copy_file_to_container(self.files["js"])
+
+        with mock.patch.object(
+            self.container, "commit_item", wraps=self.container.commit_item
+        ) as commit_item:
+            self.container.add_content_file_reference(
+                css_container_name, js_container_name
+            )
+
+        committed = [call.args[0] for call in commit_item.call_args_list]
+        self.assertEqual(committed.count(html_container_name), 1)
+
+        html = self.container.parsed(html_container_name)
+        for xpath in (
+            f'count(//xhtml:head/xhtml:link[@href="{css_container_name}"])',
+            f'count(//xhtml:head/xhtml:script[@src="{js_container_name}"])',
+        ):
+            self.assertEqual(
+                html.xpath(xpath, namespaces={"xhtml": container.XHTML_NAMESPACE}), 1
+            )
+
     def __run_single_node_test(self, text, text_only=False, number_of_sentences=None):
         self.container.paragraph_counter = defaultdict(lambda: 1)
         node = etree.Element(f"{{{container.XHTML_NAMESPACE}}}p")
@@ -362,6 +486,36 @@ class TestContainer(TestAssertions):
             ["Copyright", "by me.", "All rights reserved.", "All wrongs on retainer."]
         )
 
+    def test_add_spans_to_deeply_nested_nodes(self):
+        node = innermost = etree.Element("div")
+        for _ in range(sys.getrecursionlimit() + 100):
+            innermost = etree.SubElement(innermost, "div")
+        innermost.text = "Hello, World! Goodbye, World!"
+
+        node = self.container._add_kobo_spans_to_node(node, "test")
+
+        spans = node.xpath(
+            '//xhtml:span[@class="koboSpan"]',
+            namespaces={"xhtml": container.XHTML_NAMESPACE},
+        )
+        self.assertListEqual(
+            [span.text for span in spans], ["Hello, World!", " Goodbye, World!"]
+        )
+
+    def test_add_spans_around_entity(self):
+        node = etree.Element(f"{{{container.XHTML_NAMESPACE}}}p")
+        node.text = "Hello,"
+        node.append(etree.Entity("nbsp"))
+        node[-1].tail = "World!"
+
+        node = self.container._add_kobo_spans_to_node(node, "test")
+
+        self.assertEqual(node[1].tag, etree.Entity)
+        self.assertListEqual(
+            [span.text for span in node if span.tag != etree.Entity],
+            ["Hello,", "World!"],
+        )
+
     def test_add_spans_to_pretty_printed_text(self):
         self.__run_multiple_node_test(
             [
@@ -401,6 +555,38 @@ class TestContainer(TestAssertions):
         )
         self.assertEqual(capitolo_p_count, 1)
 
+    def test_smarten_punctuation_skips_plain_text(self):
+        plain_name = self.container.write_file_to_container(
+            (
+                f'<html xmlns="{container.XHTML_NAMESPACE}">'
+                + '<body><p class="plain">Nothing to smarten here.</p></body></html>'
+            ).encode("utf-8"),
+            name="plain.html",
+        )
+        self.container.write_file_to_container(
+            (
+                f'<html xmlns="{container.XHTML_NAMESPACE}">'
+                + '<body><p>It\'s "quoted" -- really...</p></body></html>'
+            ).encode("utf-8"),
+            name="quoted.html",
+        )
+
+        with (
+            mock.patch.object(
+                container, "smartyPants", wraps=container.smartyPants
+            ) as smarty_pants,
+            mock.patch.object(
+                self.container, "commit_item", wraps=self.container.commit_item
+            ) as commit_item,
+        ):
+            self.container.smarten_punctuation()
+
+        smartened = [call.args[0] for call in smarty_pants.call_args_list]
+        self.assertFalse(any("Nothing to smarten" in html for html in smartened))
+        self.assertTrue(any("really..." in html for html in smartened))
+        committed = [call.args[0] for call in commit_item.call_args_list]
+        self.assertNotIn(plain_name, committed)
+
     def test_github_issue_90(self):
         source_file = os.path.join(self.testfile_basedir, "page_github_90.html")
         container_name = self.container.copy_file_to_container(source_file)